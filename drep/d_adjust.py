@@ -171,9 +171,7 @@ def adjust_cluster_wrapper(wd, **kwargs):
     Xdb.loc[Xdb['alignment_coverage'] <= cov_thresh, 'ani'] = 0
 
     # Make it symmetrical
-    Xdb['av_ani'] = Xdb.apply(lambda row: dClust.average_ani (row,Xdb),axis=1)
-    Xdb['dist'] = 1 - Xdb['av_ani']
-    db = Xdb.pivot("reference","querry","dist")
+    db = dClust.gen_avani_dist_db(Xdb)
 
     # Cluster it
     if threshold == None:
@@ -272,9 +272,7 @@ def cluster_test_wrapper(wd, **kwargs):
         Xdb.loc[Xdb['alignment_coverage'] <= cov_thresh, 'ani'] = 0
 
     # Make it symmetrical
-    Xdb['av_ani'] = Xdb.apply(lambda row: dClust.average_ani (row,Xdb),axis=1)
-    Xdb['dist'] = 1 - Xdb['av_ani']
-    db = Xdb.pivot("reference","querry","dist")
+    db = dClust.gen_avani_dist_db(Xdb)
 
     # Cluster it
     if threshold == None:
@@ -1071,9 +1069,7 @@ def plot_winners(Wdb, Chdb, Wndb, Wmdb, Widb, plot_dir= False, **kwargs):
     if Wndb is not None:
         # Make a ANIn linkage for the dendrogram
         d = Wndb.copy()
-        d['av_ani'] = d.apply(lambda row: dClust.average_ani (row,d),axis=1)
-        d['dist'] = 1 - d['av_ani']
-        db = d.pivot("reference", "querry", "dist")
+        db = dClust.gen_avani_dist_db(d)
         names = list(db.columns)
         Cdb, linkage = dClust.cluster_hierarchical(db, linkage_method= 'average', \
                                     linkage_cutoff= 0)
@@ -1092,9 +1088,7 @@ def plot_winners(Wdb, Chdb, Wndb, Wmdb, Widb, plot_dir= False, **kwargs):
         # Make a ANIn linkage for the filtered dendrogram
         d = Wndb.copy()
         d.loc[d['alignment_coverage'] <= 0.1, 'ani'] = 0
-        d['av_ani'] = d.apply(lambda row: dClust.average_ani (row,d),axis=1)
-        d['dist'] = 1 - d['av_ani']
-        db = d.pivot("reference", "querry", "dist")
+        db = dClust.gen_avani_dist_db(d)
         names = list(db.columns)
         Cdb, linkage = dClust.cluster_hierarchical(db, linkage_method= 'average', \
                                     linkage_cutoff= 0)
@@ -6,15 +6,21 @@ import glob
 import shutil
 import multiprocessing
 import logging
-from subprocess import call
+from subprocess import call, Popen, PIPE
 import sys
 import json
+import tempfile
 import scipy.cluster.hierarchy
 import scipy.spatial.distance as ssd
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 import numpy as np
 import pickle
-import time
-import glob
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 import drep as dm
 import drep
@@ -140,18 +146,19 @@ def run_secondary_clustering(Bdb, Cdb, data_folder, **kwargs):
     comps = 0
     for bdb, name in iteratre_clusters(Bdb,Cdb):
         g = len(bdb['genome'].unique())
-        comps += (g * g)
+        comps += (g * (g + 1)) // 2
     time = estimate_time(comps, algorithm)
     time = time / int(kwargs.get('processors'))
     logging.info("Running {0} {1} comparisons- should take ~ {2:.1f} min".format(\
             comps, algorithm, time))
 
     # Run comparisons
-    Ndb = pd.DataFrame()
+    ndbs = []
     for bdb, name in iteratre_clusters(Bdb,Cdb):
         ndb = compare_genomes(bdb, algorithm, data_folder, **kwargs)
         ndb['MASH_cluster'] = name
-        Ndb = pd.concat([Ndb,ndb], ignore_index= True)
+        ndbs.append(ndb)
+    Ndb = pd.concat(ndbs, ignore_index= True)
 
     # Clear out clustering folder
     c_folder = data_folder + 'Clustering_files/'
@@ -162,16 +169,24 @@ def run_secondary_clustering(Bdb, Cdb, data_folder, **kwargs):
         for fn in glob.glob(data_folder + 'secondary_linkage_cluster*'):
             os.remove(fn)
 
-    # Run clustering
-    Cdb = pd.DataFrame()
-    for ndb, name in iteratre_clusters(Ndb,Ndb):
-        cdb = genome_hierarchical_clustering(ndb, c_folder, algorithm,\
-                cluster=name, **kwargs)
-        cdb['primary_cluster'] = name
-        Cdb = pd.concat([Cdb,cdb], ignore_index=True)
+    # Run clustering; each primary cluster is independent, so spread them
+    # across processes
+    p = int(kwargs.get('processors', 6))
+    c_kwargs = {k:v for k, v in kwargs.items() if k != 'Mdb'}
+    jobs = [(ndb, c_folder, algorithm, name, c_kwargs) for ndb, name in \
+                iteratre_clusters(Ndb,Ndb)]
+    cdbs = thread_map(_genome_hierarchical_clustering_job, jobs, t=p)
+    Cdb = pd.concat(cdbs, ignore_index=True)
 
     return Ndb, Cdb
 
+def _genome_hierarchical_clustering_job(job):
+    ndb, c_folder, algorithm, name, kwargs = job
+    cdb = genome_hierarchical_clustering(ndb, c_folder, algorithm,\
+            cluster=name, **kwargs)
+    cdb['primary_cluster'] = name
+    return cdb
+
 '''
 Description
 '''
@@ -237,10 +252,7 @@ def make_linkage_Ndb(Ndb,algorithm,**kwargs):
         d.loc[d['alignment_coverage'] <= cov_thresh, 'ani'] = 0
 
         # Make a linkagedb by averaging values and setting self-compare to 1
-        #d['av_ani'] = d.apply(lambda row: average_ani (row,d),axis=1)
-        add_avani(d)
-        d['dist'] = 1 - d['av_ani']
-        db = d.pivot("reference", "querry", "dist")
+        db = gen_avani_dist_db(d)
 
     if algorithm == 'gANI':
         cov_thresh = float(kwargs.get('cov_thresh',0.5))
@@ -249,19 +261,57 @@ def make_linkage_Ndb(Ndb,algorithm,**kwargs):
         d.loc[d['alignment_coverage'] < cov_thresh, 'ani'] = 0
 
         # Make a linkagedb by averaging values and setting self-compare to 1
-        #d['av_ani'] = d.apply(lambda row: average_ani (row,d),axis=1)
-        add_avani(d)
-        d['dist'] = 1 - d['av_ani']
-        #print(d[d.duplicated()])
-
-        db = d.pivot("reference", "querry", "dist")
+        db = gen_avani_dist_db(d)
 
     return db
 
 def iteratre_clusters(Bdb, Cdb, id='MASH_cluster'):
     Bdb = pd.merge(Bdb,Cdb)
-    for cluster in Bdb[id].unique():
-        d = Bdb[Bdb[id] == cluster]
+    for cluster, d in Bdb.groupby(id, sort=False):
+        yield d, cluster
+
+def _cluster_anin_job(job):
+    '''
+    Cluster the Ndb of a single MASH cluster for cluster_anin_database
+
+    Returns ([(genome, ANIn_cluster)], linkage, linkage db); the linkage and
+    linkage db are None when the cluster has one member
+    '''
+    d, cluster, S_Lmethod, S_Lcutoff, cov_thresh = job
+
+    # Remove values without enough coverage
+    d.loc[d['alignment_coverage'] <= cov_thresh, 'ani'] = 0
+
+    # Handle case where cluster has one member
+    if len(d['reference'].unique()) == 1:
+        return [(d['reference'].unique().tolist()[0], "{0}_0".format(cluster))], \
+                None, None
+
+    # Make a linkagedb
+    db = gen_avani_dist_db(d)
+
+    Gdb, linkage = cluster_hierarchical(db, linkage_method= S_Lmethod, \
+                                linkage_cutoff= S_Lcutoff)
+    rows = [(genome, "{0}_{1}".format(cluster,clust)) for genome, clust in \
+                zip(Gdb['genome'].tolist(), Gdb['cluster'].tolist())]
+
+    return rows, linkage, db
+
+def iterate_ndb_clusters(Ndb, Cdb):
+    '''
+    Yield (the rows of Ndb with a reference in the cluster, MASH cluster) for
+    every MASH cluster in Cdb, splitting Ndb in a single pass
+
+    Every MASH cluster must have at least one row in Ndb
+    '''
+    ndb = Ndb.drop(columns='MASH_cluster', errors='ignore')
+    ndb = pd.merge(ndb, Cdb[['genome','MASH_cluster']].rename(\
+                    columns={'genome':'reference'}), on='reference')
+
+    missing = set(Cdb['MASH_cluster']) - set(ndb['MASH_cluster'])
+    assert len(missing) == 0, "MASH clusters {0} have no comparisons in Ndb".format(\
+                    sorted(missing))
+    for cluster, d in ndb.groupby('MASH_cluster', sort=False):
         yield d, cluster
 
 def estimate_time(comps, alg):
@@ -345,15 +395,24 @@ def cluster_hierarchical(db, linkage_method= 'single', linkage_cutoff= 0.10):
     # Save names
     names = list(db.columns)
 
-    # Generate linkage dataframe
-    arr =  np.asarray(db)
-    try:
-        arr = ssd.squareform(arr)
-    except:
-        logging.error("The database passed in is not symmetrical!")
-        logging.error(arr)
-        sys.exit()
-    linkage = scipy.cluster.hierarchy.linkage(arr, method= linkage_method)
+    # Generate linkage dataframe; make it symmetrical explicitly so that
+    # squareform can skip its own validity checks
+    arr = np.asarray(db.values)
+    arr = arr.astype(np.result_type(arr.dtype, np.float32), copy=False)
+    arr = 0.5 * (arr + arr.T)
+    np.fill_diagonal(arr, 0)
+    arr = ssd.squareform(arr, checks=False)
+
+    return cluster_hierarchical_condensed(arr, names, linkage_method= linkage_method, \
+                                linkage_cutoff= linkage_cutoff)
+
+def cluster_hierarchical_condensed(dist, names, linkage_method= 'single', \
+                                linkage_cutoff= 0.10):
+    '''
+    Like cluster_hierarchical, but takes a condensed distance vector (as made by
+    scipy.spatial.distance.pdist) and the genome names it was made from
+    '''
+    linkage = scipy.cluster.hierarchy.linkage(dist, method= linkage_method)
 
     # Form clusters
     fclust = scipy.cluster.hierarchy.fcluster(linkage,linkage_cutoff, \
@@ -364,14 +423,44 @@ def cluster_hierarchical(db, linkage_method= 'single', linkage_cutoff= 0.10):
 
     return Cdb, linkage
 
-def gen_cdb_from_fclust(fclust,names):
+def gen_condensed_dist(db, col1, col2, dist_col='dist'):
+    '''
+    Return (condensed distance vector, sorted names) from a long-form table of
+    pairwise distances, without pivoting it into a square matrix
+
+    Self-comparisons are ignored. Both directions of a comparison are written to
+    the same spot, so whichever comes last in the table is used; the table should
+    be symmetrical. Every pair of names must be in the table
+    '''
+    names, i, j = gen_name_codes(db[col1], db[col2])
 
-    Table={'cluster':[],'genome':[]}
-    for i, c in enumerate(fclust):
-        Table['cluster'].append(c)
-        Table['genome'].append(names[i])
+    mask = i != j
+    ii = np.minimum(i[mask], j[mask])
+    jj = np.maximum(i[mask], j[mask])
 
-    return pd.DataFrame(Table)
+    # Position of (ii, jj) in the pdist layout
+    n = len(names)
+    dist = np.full(n * (n - 1) // 2, np.nan, \
+                    dtype=np.result_type(db[dist_col].values.dtype, np.float32))
+    dist[(n * ii) - ((ii * (ii + 1)) // 2) + (jj - ii - 1)] = db[dist_col].values[mask]
+    missing = int(np.isnan(dist).sum())
+    assert missing == 0, "{0} of {1} pairwise comparisons have no {2} value".format(\
+        missing, len(dist), dist_col)
+
+    return dist, list(names)
+
+def gen_name_codes(s1, s2):
+    '''
+    Return (sorted unique names in s1 and s2, index of each s1 name, index of
+    each s2 name); names are sorted to match the order pivot would give
+    '''
+    names = np.sort(pd.unique(pd.concat([s1, s2])))
+    return names, np.searchsorted(names, s1.values), np.searchsorted(names, s2.values)
+
+def gen_cdb_from_fclust(fclust,names):
+
+    return pd.DataFrame({'cluster':np.asarray(fclust, dtype=np.int32), \
+                        'genome':list(names)})
 
 
 def cluster_anin_database(Cdb, Ndb, data_folder = False, **kwargs):
@@ -397,44 +486,23 @@ def cluster_anin_database(Cdb, Ndb, data_folder = False, **kwargs):
 
     Table = {'genome':[],'ANIn_cluster':[]}
 
-    # For every MASH cluster-
-    for cluster in Cdb['MASH_cluster'].unique():
-        # Filter the database to this cluster
-        d = Ndb[Ndb['reference'].isin(Cdb['genome'][Cdb['MASH_cluster'] == cluster].tolist())]
-
-        # Remove values without enough coverage
-        d.loc[d['alignment_coverage'] <= cov_thresh, 'ani'] = 0
-
-        # Handle case where cluster has one member
-        if len(d['reference'].unique()) == 1:
-            Table['genome'].append(d['reference'].unique().tolist()[0])
-            Table['ANIn_cluster'].append("{0}_0".format(cluster))
-            continue
-
-        # Make a linkagedb
-        #d['av_ani'] = d.apply(lambda row: average_ani (row,d),axis=1)
-        add_avani(d)
-        d['dist'] = 1 - d['av_ani']
-        db = d.pivot("reference", "querry", "dist")
-
-        Gdb, linkage = cluster_hierarchical(db, linkage_method= S_Lmethod, \
-                                    linkage_cutoff= S_Lcutoff)
-
-        # For every ANIn cluster
-        for clust in Gdb['cluster'].unique():
-
-            # Filter the database to this cluster
-            d = Gdb[Gdb['cluster'] == clust]
+    # Cluster every MASH cluster; they're independent, so spread them across
+    # processes
+    p = int(kwargs.get('processors', 6))
+    jobs = [(d, cluster, S_Lmethod, S_Lcutoff, cov_thresh) for d, cluster in \
+                iterate_ndb_clusters(Ndb, Cdb)]
+    results = thread_map(_cluster_anin_job, jobs, t=p)
 
-            # For every genome in this cluster
-            for genome in d['genome'].tolist():
+    for job, (rows, linkage, db) in zip(jobs, results):
+        cluster = job[1]
 
-                # Save cluster information
-                Table['genome'].append(genome)
-                Table['ANIn_cluster'].append("{0}_{1}".format(cluster,clust))
+        # Save cluster information
+        for genome, clust in rows:
+            Table['genome'].append(genome)
+            Table['ANIn_cluster'].append(clust)
 
         # Save the linkage
-        if (data_folder != False):
+        if (data_folder != False) and (linkage is not None):
             arguments = {'linkage_method':S_Lmethod,'linkage_cutoff':S_Lcutoff,\
                         'comparison_algorithm':'ANIn','minimum_coverage':cov_thresh}
             pickle_name = "secondary_linkage_cluster_{0}.pickle".format(cluster)
@@ -462,9 +530,7 @@ def cluster_anin_simple(Cdb, Ndb, ANIn=.99, cov_thresh=0.5):
     Table = {'genome':[],'ANIn_cluster':[]}
 
     # For every MASH cluster-
-    for cluster in Cdb['MASH_cluster'].unique():
-        # Filter the database to this cluster
-        d = Ndb[Ndb['reference'].isin(Cdb['genome'][Cdb['MASH_cluster'] == cluster].tolist())]
+    for d, cluster in iterate_ndb_clusters(Ndb, Cdb):
 
         # Make a graph of the genomes in this cluster based on Ndb
         g = make_graph_anin(d,cov_thresh=cov_thresh,anin_thresh=ANIn)
@@ -486,6 +552,31 @@ def cluster_anin_simple(Cdb, Ndb, ANIn=.99, cov_thresh=0.5):
 
     return pd.merge(Gdb,Cdb)
 
+def make_graph_anin(df, cov_thresh=0.5, anin_thresh=.99):
+    '''
+    Return the genome names in df and a sparse adjacency matrix connecting those
+    with both alignment coverage and ANI above the thresholds given
+    '''
+    codes, names = pd.factorize(pd.concat([df['reference'], df['querry']]))
+    src = codes[:len(df)]
+    dst = codes[len(df):]
+
+    mask = ((df['alignment_coverage'] > cov_thresh) & (df['ani'] > anin_thresh)).values
+    graph = scipy.sparse.csr_matrix((np.ones(mask.sum()), (src[mask], dst[mask])), \
+                                    shape=(len(names), len(names)))
+
+    return names, graph
+
+def cluster_graph(g):
+    '''
+    Return a dataframe with the columns genome and cluster, where each cluster is
+    a connected component of the graph made by make_graph_anin
+    '''
+    names, graph = g
+    n_comp, labels = connected_components(graph, directed=False)
+
+    return pd.DataFrame({'genome':list(names), 'cluster':labels})
+
 def run_anin_on_clusters(Bdb, Cdb, data_folder, **kwargs):
 
     """
@@ -515,20 +606,19 @@ def run_anin_on_clusters(Bdb, Cdb, data_folder, **kwargs):
     # Step 1. Make the directories and generate the list of commands to be run
     cmds = []
     files = []
-    for cluster in Bdb['MASH_cluster'].unique():
-        d = Bdb[Bdb['MASH_cluster'] == cluster]
+    existing = get_delta_names(ANIn_folder)
+    for cluster, d in Bdb.groupby('MASH_cluster', sort=False):
         genomes = d['location'].tolist()
-        for g1 in genomes:
-            for g2 in genomes:
-                file_name = "{0}{1}_vs_{2}".format(ANIn_folder, \
-                            get_genome_name_from_fasta(g1),\
-                            get_genome_name_from_fasta(g2))
-                files.append(file_name + '.delta')
+        for g1, g2 in gen_genome_pairs(genomes):
+            name = "{0}_vs_{1}".format(get_genome_name_from_fasta(g1),\
+                        get_genome_name_from_fasta(g2))
+            file_name = ANIn_folder + name
+            files.append(file_name + '.delta')
 
-                # If the file doesn't already exist, add it to what needs to be run
-                if not os.path.isfile(file_name + '.delta'):
-                    cmds.append(gen_nucmer_cmd(file_name,g1,g2,c=n_c,noextend=n_noextend,\
-                                maxgap=n_maxgap,method=n_method))
+            # If the file doesn't already exist, add it to what needs to be run
+            if (name + '.delta') not in existing:
+                cmds.append(gen_nucmer_cmd(file_name,g1,g2,c=n_c,noextend=n_noextend,\
+                            maxgap=n_maxgap,method=n_method))
 
     # Step 2. Run the nucmer commands
 
@@ -538,21 +628,88 @@ def run_anin_on_clusters(Bdb, Cdb, data_folder, **kwargs):
 
     # Step 3. Parse the nucmer output
 
-    org_lengths = {y:dm.fasta_length(x) for x,y in zip(Bdb['location'].tolist(),Bdb['genome'].tolist())}
-    Ndb = process_deltadir(files, org_lengths)
-    Ndb['MASH_cluster'] = None
-    for cluster in Bdb['MASH_cluster'].unique():
-        d = Bdb[Bdb['MASH_cluster'] == cluster]
-        Ndb['MASH_cluster'][Ndb['reference'].isin(d['genome'].tolist())] = cluster
+    loc2length = get_genome_lengths(Bdb['location'].tolist(), p=p, \
+                    cache_file= ANIn_folder + 'org_lengths.json')
+    org_lengths = {y:loc2length[x] for x,y in zip(Bdb['location'].tolist(),Bdb['genome'].tolist())}
+    Ndb = process_deltadir(files, org_lengths, p=p)
+    genome2cluster = dict(zip(Bdb['genome'], Bdb['MASH_cluster']))
+    Ndb['MASH_cluster'] = Ndb['reference'].map(genome2cluster)
 
     return Ndb
 
+def get_genome_lengths(locations, p=1, cache_file=None):
+    '''
+    Return a dictionary of fasta location -> total sequence length
+
+    Lengths are calculated across p processes. If cache_file is given, lengths
+    saved there are re-used as long as the fasta file's size and modification
+    time haven't changed, and any new lengths are added to it. A cache that can't
+    be read is ignored
+    '''
+    cache = {}
+    if (cache_file is not None) and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as fp:
+                cache = json.load(fp)
+        except ValueError:
+            cache = None
+        if not isinstance(cache, dict):
+            logging.debug("Ignoring unreadable genome length cache {0}".format(cache_file))
+            cache = {}
+
+    stats = {}
+    for loc in locations:
+        st = os.stat(loc)
+        stats[loc] = [st.st_size, st.st_mtime]
+
+    todo = [loc for loc in stats if cache.get(loc, [None, None, None])[:2] != stats[loc]]
+    if len(todo) > 0:
+        lengths = thread_map(dm.fasta_length, todo, t=p)
+
+        for loc, length in zip(todo, lengths):
+            cache[loc] = stats[loc] + [length]
+
+        # Write to a temporary file first, so an interrupted run can't leave a
+        # half-written cache behind
+        if cache_file is not None:
+            with open(cache_file + '.tmp', 'w') as fp:
+                json.dump(cache, fp)
+            os.replace(cache_file + '.tmp', cache_file)
+
+    return {loc:cache[loc][2] for loc in stats}
+
+def get_delta_names(folder):
+    '''
+    Return the set of .delta file names in folder, found with a single scan
+    '''
+    if not os.path.isdir(folder):
+        return set()
+    with os.scandir(folder) as it:
+        return set(e.name for e in it if e.name.endswith('.delta'))
+
+def gen_genome_pairs(genomes):
+    '''
+    Yield (g1, g2) for every unordered pair of genome locations, including each
+    genome with itself
+
+    Each pair is put in order of genome name, so the direction nucmer is run in
+    doesn't depend on the order the genomes were given in
+    '''
+    genomes = sorted(genomes, key=get_genome_name_from_fasta)
+    for i, g1 in enumerate(genomes):
+        for g2 in genomes[i:]:
+            yield g1, g2
+
 def gen_nucmer_commands(genomes,outf,c=65,maxgap=90,noextend=False,method='mum'):
+    '''
+    Make one nucmer command per unordered pair of genomes (and one per genome
+    against itself). Reverse comparisons are filled in when parsing the .delta
+    files
+    '''
     cmds = []
-    for g1 in genomes:
-        for g2 in genomes:
-            out = "{0}{1}_vs_{2}".format(outf,get_genome_name_from_fasta(g1),get_genome_name_from_fasta(g2))
-            cmds.append(gen_nucmer_cmd(out,g1,g2,c=c,noextend=noextend,maxgap=maxgap,method=method))
+    for g1, g2 in gen_genome_pairs(genomes):
+        out = "{0}{1}_vs_{2}".format(outf,get_genome_name_from_fasta(g1),get_genome_name_from_fasta(g2))
+        cmds.append(gen_nucmer_cmd(out,g1,g2,c=c,noextend=noextend,maxgap=maxgap,method=method))
 
     return cmds
 
@@ -563,11 +720,8 @@ def run_nucmer_genomeList(genomes,outf,b2s,c=65,maxgap=90,noextend=False,method=
     """
 
     # Run commands on biotite
-    cmds = []
-    for g1 in genomes:
-        for g2 in genomes:
-            out = "{0}{1}_vs_{2}".format(outf,get_genome_name_from_fasta(g1),get_genome_name_from_fasta(g2))
-            cmds.append(gen_nucmer_cmd(out,g1,g2,c=c,noextend=noextend,maxgap=maxgap,method=method))
+    cmds = gen_nucmer_commands(genomes,outf,c=c,maxgap=maxgap,noextend=noextend,\
+                                method=method)
     if not dry:
         thread_nucmer_cmds_status(cmds, t=p)
 
@@ -589,57 +743,86 @@ def all_vs_all_MASH(Bdb, data_folder, **kwargs):
     dry = kwargs.get('dry',False)
     overwrite = kwargs.get('overwrite', False)
     mash_exe = kwargs.get('mash_exe', 'mash')
+    p = kwargs.get('processors', 6)
 
     # Set up folders
     MASH_folder = data_folder + 'MASH_files/'
     if not os.path.exists(MASH_folder):
         os.makedirs(MASH_folder)
 
-    sketch_folder = MASH_folder + 'sketches/'
-    if not os.path.exists(sketch_folder):
-        os.makedirs(sketch_folder)
-
-    # Make the MASH sketches
-    cmds = []
-    for fasta in Bdb['location'].unique():
-        genome = Bdb['genome'][Bdb['location'] == fasta].tolist()[0]
-        file = sketch_folder + genome
-        if not os.path.isfile(file + '.msh'):
-            cmd = [mash_exe, 'sketch', fasta, '-s', str(MASH_s), '-o',
-                file]
-            cmds.append(cmd)
-
-    if not dry:
-        if len(cmds) > 0:
-            thread_mash_cmds_status(cmds)
-
-    # Combine MASH sketches
-    cmd = [mash_exe, 'paste', MASH_folder + 'ALL.msh', sketch_folder+ '*']
-    cmd = ' '.join(cmd)
-    dm.run_cmd(cmd,dry,True)
+    # Make a single MASH sketch of all genomes
+    locations = Bdb['location'].unique().tolist()
+    sketch_list = MASH_folder + 'sketch_list.txt'
+    with open(sketch_list, 'w') as o:
+        o.write('\n'.join(locations) + '\n')
 
-    # Calculate distances
     all_file = MASH_folder + 'ALL.msh'
-    cmd = [mash_exe, 'dist', all_file, all_file, '>', MASH_folder
-            + 'MASH_table.tsv']
+    if os.path.isfile(all_file) and not dry:
+        os.remove(all_file)
+    cmd = [mash_exe, 'sketch', '-l', sketch_list, '-p', str(p), '-s', str(MASH_s),
+            '-o', all_file]
     cmd = ' '.join(cmd)
     dm.run_cmd(cmd,dry,True)
 
-    # Make Mdb based on all genomes in the MASH folder
-    Mdb = pd.DataFrame()
-    file = MASH_folder + 'MASH_table.tsv'
+    # Calculate distances; only the lower triangle is reported, and it's read
+    # straight from mash's output rather than through a table on disk
+    cmd = [mash_exe, 'triangle', '-E', '-p', str(p), all_file]
+    mdb = parse_mash_triangle(None)
+    if dry:
+        print(' '.join(cmd))
+    else:
+        # stderr goes to a file so that a chatty mash can't block the pipe
+        with tempfile.TemporaryFile() as errf:
+            proc = Popen(cmd, stdout=PIPE, stderr=errf)
+            mdb = parse_mash_triangle(proc.stdout)
+            code = proc.wait()
+            errf.seek(0)
+            err = errf.read().decode('utf-8', 'replace').strip()
+
+        # Only one genome can give an empty table
+        if (code != 0) or ((len(mdb) == 0) and (len(locations) > 1)):
+            logging.error("{0} failed (exit code {1}, {2} comparisons reported); " \
+                "mash v2.0 or later is needed for mash triangle. mash said: {3}"\
+                .format(' '.join(cmd), code, len(mdb), err))
+            sys.exit(1)
+        logging.debug("mash triangle stderr: {0}".format(err))
+
+    return gen_mdb_from_triangle(mdb, locations, MASH_s)
+
+def parse_mash_triangle(handle):
+    '''
+    Read the output of mash triangle -E from handle into a table with the columns
+    genome1, genome2, dist, p and kmers
+
+    An empty table is returned if handle is None or has nothing in it (which is
+    what mash gives for a single genome)
+    '''
+    columns = ['genome1','genome2','dist','p','kmers']
+    if handle is None:
+        return pd.DataFrame(columns=columns)
+    try:
+        return pd.read_csv(handle,sep='\t',header = None, names=columns)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=columns)
+
+def gen_mdb_from_triangle(mdb, locations, MASH_s):
+    '''
+    Make Mdb from a table made by parse_mash_triangle, for the genomes at
+    locations sketched with a sketch size of MASH_s
+    '''
+    columns = ['genome1','genome2','dist','p','kmers']
 
-    table = pd.read_csv(file,sep='\t',header = None)
-    table.columns = ['genome1','genome2','dist','p','kmers']
-    table['genome1'] = table['genome1'].apply(get_genome_name_from_fasta)
-    table['genome2'] = table['genome2'].apply(get_genome_name_from_fasta)
-    Mdb = pd.concat([Mdb,table],ignore_index=True)
-    Mdb['similarity'] = 1 - Mdb['dist'].astype(float)
+    # Make Mdb
+    mdb['genome1'] = mdb['genome1'].apply(get_genome_name_from_fasta)
+    mdb['genome2'] = mdb['genome2'].apply(get_genome_name_from_fasta)
 
-    # Filter out those genomes that are in the MASH folder but shouldn't be in Mdb
-    genomes = Bdb['genome'].unique()
-    Mdb = Mdb[Mdb['genome1'].isin(genomes)]
-    Mdb = Mdb[Mdb['genome2'].isin(genomes)]
+    # Add the reverse and self comparisons, which mash triangle doesn't report
+    genomes = [get_genome_name_from_fasta(l) for l in locations]
+    sdb = pd.DataFrame({'genome1':genomes, 'genome2':genomes, 'dist':0, 'p':0,
+                        'kmers':"{0}/{0}".format(MASH_s)})
+    Mdb = pd.concat([mdb, mdb.rename(columns={'genome1':'genome2', 'genome2':'genome1'}),
+                        sdb[columns]], ignore_index=True)
+    Mdb['similarity'] = 1 - Mdb['dist']
 
     return Mdb
 
@@ -658,12 +841,16 @@ def cluster_mash_database(db, data_folder= False, **kwargs):
             os.makedirs(data_folder)
 
     db['dist'] = 1 - db['similarity']
-    linkage_db = db.pivot("genome1","genome2","dist")
-    Cdb, linkage = cluster_hierarchical(linkage_db, linkage_method= P_Lmethod, \
-                                linkage_cutoff= P_Lcutoff)
+    dist, names = gen_condensed_dist(db, 'genome1', 'genome2')
+    Cdb, linkage = cluster_hierarchical_condensed(dist, names, \
+                    linkage_method= P_Lmethod, linkage_cutoff= P_Lcutoff)
     Cdb = Cdb.rename(columns={'cluster':'MASH_cluster'})
 
     if (data_folder != False):
+        # The square distance database is only made for the pickle
+        linkage_db = pd.DataFrame(ssd.squareform(dist, checks=False), \
+                    index=pd.Index(names, name='genome1'), \
+                    columns=pd.Index(names, name='genome2'))
         arguments = {'linkage_method':P_Lmethod,'linkage_cutoff':P_Lcutoff,\
                         'comparison_algorithm':'MASH'}
         logging.debug('Saving primary_linkage pickle to {0}'.format(data_folder))
@@ -685,16 +872,75 @@ def parse_delta(filename):
     aligned uniquely-matched region, and returns the cumulative total for
     each as a tuple.
     """
+    if njit is not None:
+        with open(filename, 'rb') as fh:
+            buf = np.frombuffer(fh.read(), dtype=np.uint8)
+        aln_length, sim_errors = _parse_delta_buffer(buf)
+        return int(aln_length), int(sim_errors)
+
+    return _parse_delta_lines(filename)
+
+def _parse_delta_lines(filename):
+    '''
+    Same as parse_delta, but streams the .delta file line by line in python;
+    used when numba isn't installed
+    '''
+    aln_length, sim_errors = 0, 0
+    with open(filename) as fh:
+        for line in fh:
+            parts = line.split()
+            if not parts or parts[0] == 'NUCMER' or parts[0].startswith('>'):  # Skip headers
+                continue
+            # We only process lines with seven columns:
+            if len(parts) == 7:
+                aln_length += abs(int(parts[1]) - int(parts[0]))
+                sim_errors += int(parts[4])
+    return aln_length, sim_errors
+
+def _parse_delta_buffer(buf):
+    '''
+    Same as parse_delta, but walks the raw bytes of a .delta file one character
+    at a time so that numba can compile it
+    '''
     aln_length, sim_errors = 0, 0
-    for line in [l.strip().split() for l in open(filename, 'rU').readlines()]:
-        if line[0] == 'NUCMER' or line[0].startswith('>'):  # Skip headers
-            continue
-        # We only process lines with seven columns:
-        if len(line) == 7:
-            aln_length += abs(int(line[1]) - int(line[0]))
-            sim_errors += int(line[4])
+    n = len(buf)
+    i = 0
+    while i < n:
+        # Find the end of this line
+        j = i
+        while j < n and buf[j] != 10:
+            j += 1
+
+        # Skip headers ('>' and 'NUCMER')
+        if j > i and buf[i] != 62 and buf[i] != 78:
+            fields, value, in_field = 0, 0, False
+            start, end, errors = 0, 0, 0
+            for k in range(i, j + 1):
+                c = int(buf[k]) if k < j else 32
+                if c == 32 or c == 9 or c == 13:
+                    if in_field:
+                        if fields == 0:
+                            start = value
+                        elif fields == 1:
+                            end = value
+                        elif fields == 4:
+                            errors = value
+                        fields += 1
+                        value, in_field = 0, False
+                else:
+                    value = (value * 10) + (c - 48)
+                    in_field = True
+
+            # We only process lines with seven columns:
+            if fields == 7:
+                aln_length += abs(end - start)
+                sim_errors += errors
+        i = j + 1
     return aln_length, sim_errors
 
+if njit is not None:
+    _parse_delta_buffer = njit(cache=True, nogil=True)(_parse_delta_buffer)
+
 def gen_gANI_cmd(file, g1, g2, dir, exe):
     # Handle self comparison
     # Did a pretty exhaustive test- same comaprisons always give 100% ANI
@@ -711,114 +957,104 @@ def gen_gANI_cmd(file, g1, g2, dir, exe):
     return cmd
 
 
-def process_deltadir(deltafiles, org_lengths, logger=None):
+def process_deltadir(deltafiles, org_lengths, logger=None, p=1):
     """Returns a tuple of ANIm results for .deltas in passed directory.
     - delta_dir - path to the directory containing .delta files
     - org_lengths - dictionary of total sequence lengths, keyed by sequence
+    - p - number of processes to parse the .delta files with
     Returns the following pandas dataframes in a tuple; query sequences are
     rows, subject sequences are columns:
     - alignment_lengths - symmetrical: total length of alignment
     - percentage_identity - symmetrical: percentage identity of alignment
     - alignment_coverage - non-symmetrical: coverage of query and subject
     - similarity_errors - symmetrical: count of similarity errors
-    May throw a ZeroDivisionError if one or more NUCmer runs failed, or a
-    very distant sequence was included in the analysis.
+    Comparisons with a total alignment length of zero are given an ANI of 0;
+    common causes are that a NUCmer run failed, or that a very distant sequence
+    was included in the analysis.
     """
     # Process directory to identify input files
     #deltafiles = glob.glob(delta_dir + '*.delta')
 
-    Table = {'querry':[],'reference':[],'alignment_length':[],'similarity_errors':[],
-            'ref_coverage':[],'querry_coverage':[],'ani':[], 'reference_length':[],
-            'querry_length':[],'alignment_coverage':[]}
-
-    # Process .delta files assuming that the filename format holds:
-    # org1_vs_org2.delta
-    zero_error = False  # flag to register a divide-by-zero error
-    for deltafile in deltafiles:
-        qname, sname = os.path.splitext(os.path.split(deltafile)[-1])[0].split('_vs_')
-        tot_length, tot_sim_error = parse_delta(deltafile)
-        if tot_length == 0 and logger is not None:
-            logging.info("Total alignment length reported in " +
-                               "%s is zero!" % deltafile)
-        query_cover = float(tot_length) / org_lengths[qname]
-        sbjct_cover = float(tot_length) / org_lengths[sname]
-        # Calculate percentage ID of aligned length. This may fail if
-        # total length is zero.
-        # The ZeroDivisionError that would arise should be handled
-        # Common causes are that a NUCmer run failed, or that a very
-        # distant sequence was included in the analysis.
-        try:
-            perc_id = 1 - float(tot_sim_error) / tot_length
-        except ZeroDivisionError:
-            #print("Alignment between {0} and {1} has 0 alignment!".format(qname,sname))
-            perc_id = 0  # set arbitrary value of zero identity
-            zero_error = True
-
-        Table['querry'].append(qname)
-        Table['querry_length'].append(org_lengths[qname])
-        Table['reference'].append(sname)
-        Table['reference_length'].append(org_lengths[sname])
-        Table['alignment_length'].append(tot_length)
-        Table['similarity_errors'].append(tot_sim_error)
-        Table['ani'].append(perc_id)
-        Table['ref_coverage'].append(sbjct_cover)
-        Table['querry_coverage'].append(query_cover)
-        Table['alignment_coverage'].append((tot_length * 2)/(org_lengths[qname]\
-                                                             + org_lengths[sname]))
-
-    df = pd.DataFrame(Table)
-    return df
+    rows = parse_deltafiles(deltafiles, logger=logger, p=p)
+    rows = add_symmetric_deltas(rows)
+    return gen_ndb_from_deltas(rows, org_lengths, coverage_method='total')
 
 def process_deltafiles(deltafiles, org_lengths, logger=None, **kwargs):
 
-    Table = {'querry':[],'reference':[],'alignment_length':[],'similarity_errors':[],
-            'ref_coverage':[],'querry_coverage':[],'ani':[], 'reference_length':[],
-            'querry_length':[],'alignment_coverage':[]}
-
     # Process .delta files assuming that the filename format holds:
     # org1_vs_org2.delta
     coverage_method = kwargs.get('coverage_method')
     logging.debug('coverage_method is {0}'.format(coverage_method))
 
-    for deltafile in deltafiles:
-        qname, sname = os.path.splitext(os.path.split(deltafile)[-1])[0].split('_vs_')
-        tot_length, tot_sim_error = parse_delta(deltafile)
-        if tot_length == 0 and logger is not None:
-            logging.info("Total alignment length reported in " +
-                               "%s is zero!" % deltafile)
-        query_cover = float(tot_length) / org_lengths[qname]
-        sbjct_cover = float(tot_length) / org_lengths[sname]
-        # Calculate percentage ID of aligned length. This may fail if
-        # total length is zero.
-        # The ZeroDivisionError that would arise should be handled
-        # Common causes are that a NUCmer run failed, or that a very
-        # distant sequence was included in the analysis.
-        try:
-            perc_id = 1 - float(tot_sim_error) / tot_length
-        except ZeroDivisionError:
-            #print("Alignment between {0} and {1} has 0 alignment!".format(qname,sname))
-            perc_id = 0  # set arbitrary value of zero identity
-            zero_error = True
-
-        Table['querry'].append(qname)
-        Table['querry_length'].append(org_lengths[qname])
-        Table['reference'].append(sname)
-        Table['reference_length'].append(org_lengths[sname])
-        Table['alignment_length'].append(tot_length)
-        Table['similarity_errors'].append(tot_sim_error)
-        Table['ani'].append(perc_id)
-        Table['ref_coverage'].append(sbjct_cover)
-        Table['querry_coverage'].append(query_cover)
-
-        if coverage_method == 'total':
-            Table['alignment_coverage'].append((tot_length * 2)/(org_lengths[qname]\
-                                                             + org_lengths[sname]))
-        elif coverage_method == 'larger':
-            Table['alignment_coverage'].append(max((tot_length/org_lengths[qname]),\
-                (tot_length/org_lengths[sname])))
-
-    df = pd.DataFrame(Table)
-    return df
+    p = kwargs.get('processors', 6)
+
+    rows = parse_deltafiles(deltafiles, logger=logger, p=p)
+    rows = add_symmetric_deltas(rows)
+    return gen_ndb_from_deltas(rows, org_lengths, coverage_method=coverage_method)
+
+def parse_deltafiles(deltafiles, logger=None, p=1):
+    '''
+    Return a list of (querry, reference, alignment_length, similarity_errors)
+    tuples; one per .delta file. The filename format must be org1_vs_org2.delta
+
+    The files are parsed across p processes
+    '''
+    rows = thread_map(_parse_delta_named, deltafiles, t=p)
+
+    if logger is not None:
+        for deltafile, row in zip(deltafiles, rows):
+            if row[2] == 0:
+                logging.info("Total alignment length reported in " +
+                                   "%s is zero!" % deltafile)
+    return rows
+
+def _parse_delta_named(deltafile):
+    name = os.path.basename(deltafile)
+    if name.endswith('.delta'):
+        name = name[:-6]
+    qname, _, sname = name.partition('_vs_')
+    tot_length, tot_sim_error = parse_delta(deltafile)
+    return (qname, sname, tot_length, tot_sim_error)
+
+def add_symmetric_deltas(rows):
+    '''
+    Fill in the comparisons that nucmer isn't run for
+
+    Only one .delta file is made per pair of genomes, so add the reverse of
+    every row in rows that isn't a self-comparison
+    '''
+    return rows + [(s, q, l, e) for q, s, l, e in rows if q != s]
+
+def gen_ndb_from_deltas(rows, org_lengths, coverage_method='total'):
+    '''
+    Make an Ndb from the tuples returned by parse_deltafiles
+
+    The table is built once, and coverage / ANI are then calculated as column
+    operations. coverage_method is either 'total' or 'larger'
+    '''
+    df = pd.DataFrame.from_records(rows, columns=['querry', 'reference', \
+                                    'alignment_length', 'similarity_errors'])
+    reference_length = df['reference'].map(org_lengths)
+    querry_length = df['querry'].map(org_lengths)
+
+    df['ref_coverage'] = df['alignment_length'] / reference_length
+    df['querry_coverage'] = df['alignment_length'] / querry_length
+
+    # Set an arbitrary value of zero identity when there is no alignment
+    df['ani'] = (1 - (df['similarity_errors'] / \
+                df['alignment_length'].replace(0, np.nan))).fillna(0)
+    df['reference_length'] = reference_length
+    df['querry_length'] = querry_length
+
+    if coverage_method == 'total':
+        df['alignment_coverage'] = (df['alignment_length'] * 2) / \
+                (df['querry_length'] + df['reference_length'])
+    elif coverage_method == 'larger':
+        df['alignment_coverage'] = df[['ref_coverage', 'querry_coverage']].max(axis=1)
+
+    # None of these have more than float32 precision to begin with
+    return df.astype({c:np.float32 for c in ['ref_coverage', 'querry_coverage', \
+                        'ani', 'alignment_coverage'] if c in df.columns})
 
 ### MAKE IT SO THAT YOU REMOVE THE _TEMP MARKER FROM THE GENOMES, AND DELTE THE
 ### FILE WHILE YOU'RE AT IT
@@ -900,27 +1136,25 @@ def run_pairwise_ANIn(genome_list, ANIn_folder, **kwargs):
     # Gen commands
     cmds = []
     files = []
-    for g1 in genomes:
-        for g2 in genomes:
-            file_name = "{0}{1}_vs_{2}".format(ANIn_folder, \
-                        get_genome_name_from_fasta(g1),\
-                        get_genome_name_from_fasta(g2))
-            files.append(file_name)
+    existing = get_delta_names(ANIn_folder)
+    for g1, g2 in gen_genome_pairs(genomes):
+        name = "{0}_vs_{1}".format(get_genome_name_from_fasta(g1),\
+                    get_genome_name_from_fasta(g2))
+        file_name = ANIn_folder + name
+        files.append(file_name)
 
-            # If the file doesn't already exist, add it to what needs to be run
-            if not os.path.isfile(file_name + '.delta'):
-                cmds.append(gen_nucmer_cmd(file_name,g1,g2))
+        # If the file doesn't already exist, add it to what needs to be run
+        if (name + '.delta') not in existing:
+            cmds.append(gen_nucmer_cmd(file_name,g1,g2))
 
     # Run commands
     if len(cmds) > 0:
         thread_nucmer_cmds_status(cmds,p,verbose=False)
 
     # Parse output
-    org_lengths = {}
-    for genome in genomes:
-        #logging.debug("getting genome length of {0}".format(genome))
-        org_lengths[get_genome_name_from_fasta(genome)] = dm.fasta_length(genome)
-
+    loc2length = get_genome_lengths(genomes, p=p, \
+                    cache_file= ANIn_folder + 'org_lengths.json')
+    org_lengths = {get_genome_name_from_fasta(g):l for g, l in loc2length.items()}
 
     deltafiles = ["{0}.delta".format(file) for file in files]
     df = process_deltafiles(deltafiles, org_lengths, **kwargs)
@@ -1074,10 +1308,7 @@ def gen_nucmer_cmd(prefix,ref,querry,c='65',noextend=False,maxgap='90',method='m
     return cmd
 
 def thread_nucmer_cmds(cmds,t=10):
-    pool = multiprocessing.Pool(processes=t)
-    pool.map(run_nucmer_cmd,cmds)
-    pool.close()
-    pool.join()
+    thread_nucmer_cmds_status(cmds,t=t,verbose=False)
     return
 
 def thread_nucmer_cmds_status(cmds,t=10,verbose=True):
@@ -1085,31 +1316,52 @@ def thread_nucmer_cmds_status(cmds,t=10,verbose=True):
     if verbose:
         minutes = ((float(total) * (float(0.33))) /float(t))
         logging.info("Running {0} mummer comparisons: should take ~ {1:.1f} min".format(total,minutes))
-    pool = multiprocessing.Pool(processes=int(t))
-    rs = pool.map_async(run_nucmer_cmd,cmds)
-    pool.close()
-
-    pool.join()
+    thread_cmds_status(cmds,t=t,progress=verbose)
     return
 
 def thread_mash_cmds_status(cmds,t=10):
+    thread_cmds_status(cmds,t=t,progress=True)
+    return
+
+def thread_map(func, items, t=1):
+    '''
+    Return [func(x) for x in items], worked out across t processes
+
+    Items are handed out in chunks, and everything is run in this process when
+    there's only one process or one item
+    '''
+    items = list(items)
+    t = min(int(t), len(items))
+    if t <= 1:
+        return [func(x) for x in items]
+
+    chunksize = max(1, len(items) // (4 * t))
+    with multiprocessing.Pool(processes=t) as pool:
+        return pool.map(func, items, chunksize=chunksize)
+
+def thread_cmds_status(cmds,t=10,progress=True):
+    '''
+    Run the commands across t processes, updating a progress bar as each one
+    finishes
+    '''
     total = len(cmds)
-    pool = multiprocessing.Pool(processes=t)
-    rs = pool.map_async(run_nucmer_cmd,cmds)
-    pool.close()
-
-    while(True):
-        done = total - (rs._number_left * rs._chunksize)
-        percR = (done/total) * 100
-        sys.stdout.write('\r')
-        sys.stdout.write("[{0:20}] {1:3.2f}%".format('='*int(percR/5), percR))
-        sys.stdout.flush()
-        if (rs.ready()):
-            sys.stdout.write('\n')
-            break
-        time.sleep(0.5)
-
-    pool.join()
+    t = int(t)
+    chunksize = max(1, total // (4 * t))
+
+    # The pool is terminated on the way out, even when a command raises
+    with multiprocessing.Pool(processes=t) as pool:
+        try:
+            for done, _ in enumerate(pool.imap_unordered(run_nucmer_cmd, cmds, \
+                                    chunksize=chunksize), 1):
+                if progress:
+                    percR = (done/total) * 100
+                    sys.stdout.write('\r')
+                    sys.stdout.write("[{0:20}] {1:3.2f}%".format('='*int(percR/5), percR))
+                    sys.stdout.flush()
+        finally:
+            if progress:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
     return
 
 def gen_nomash_cdb(Bdb):
@@ -1142,37 +1394,28 @@ def load_genomes(genome_list):
     Bdb = pd.DataFrame(Table)
     return Bdb
 
-def average_ani(row,db):
-    g1 = row['querry']
-    g2 = row['reference']
-    if g1 == g2:
-        return 1
-    else:
-        ani1 = float(row['ani'])
-        ani2 = float(db['ani'][(db['reference'] == g1) & (db['querry'] == g2)].tolist()[0])
-        avg = np.mean([ani1,ani2])
-        return avg
-
-def add_avani(db):
+def gen_avani_dist_db(db):
     '''
-    add a column titled 'av_ani' to the passed in dataframe
+    Return a square distance dataframe (1 - average ANI) of all genomes in db
 
-    dataframe must have rows reference, querey, and ani.
+    dataframe must have rows reference, querry, and ani. The ANI of each pair is
+    averaged with the reverse comparison in a single matrix operation, and
+    self-comparisons are set to a distance of 0.
     '''
-
-    logging.debug('making dictionary for average_ani')
-    combo2value = {}
-    for i, row in db.iterrows():
-        combo2value["{0}-vs-{1}".format(row['querry'], row['reference'])] \
-            = row['ani']
-
-    logging.debug('list comprehension for average_ani')
-    db['av_ani'] = [np.mean([combo2value["{0}-vs-{1}".format(q,r)], \
-                        combo2value["{0}-vs-{1}".format(r,q)]]) if r != q else 1\
-                        for q, r in zip(db['querry'].tolist(), \
-                        db['reference'].tolist())]
-
-    logging.debug('averageing done')
+    # This is memory-bound rather than compute-bound, so fill a contiguous
+    # float32 matrix by integer index instead of building a pivot table
+    names, r, q = gen_name_codes(db['reference'], db['querry'])
+    K = len(names)
+    A = np.full((K, K), np.nan, dtype=np.float32)
+    A[r, q] = db['ani'].values
+
+    dist = A + A.T
+    dist *= -0.5
+    dist += 1
+    np.fill_diagonal(dist, 0)
+
+    return pd.DataFrame(dist, index=pd.Index(names, name='reference'), \
+                        columns=pd.Index(names, name='querry'))
 
 def nucmer_preset(preset):
    #nucmer argument c, n_maxgap, n_noextend, n_method
@@ -146,26 +146,30 @@ def evaluate_warnings(wd, **kwargs):
     # Check for cases where winners are very similar
     # Either based on MASH or ANIn
     if wd.hasDb('Wmdb'):
+        genome2cluster = Cdb.drop_duplicates('genome').set_index('genome')\
+                            ['secondary_cluster'].to_dict()
+
         # See if any MASH comparisons are too similar
         Wmdb = Wmdb[(Wmdb['genome1'] != Wmdb['genome2']) & (Wmdb['similarity'] > warn_sim)\
                    & (Wmdb['genome1'] > Wmdb['genome2'])]
-        for i,row in Wmdb.iterrows():
-            c1 = Cdb['secondary_cluster'][Cdb['genome'] == row['genome1']].tolist()[0]
-            c2 = Cdb['secondary_cluster'][Cdb['genome'] == row['genome2']].tolist()[0]
+        for row in Wmdb[['genome1', 'genome2', 'similarity']].itertuples(index=False):
+            c1 = genome2cluster[row.genome1]
+            c2 = genome2cluster[row.genome2]
 
             warning = "WINNER WARNING: Genomes {0} ({3}) and {1} ({4}) have a high MASH score ({2:.2f}%)".format(\
-                        row['genome1'], row['genome2'], row['similarity']*100, c1, c2)
+                        row.genome1, row.genome2, row.similarity*100, c1, c2)
             warnings.append(warning)
 
         # See if any secondary comparisons are too similar
         Wndb = Wndb[(Wndb['reference'] != Wndb['querry']) & (Wndb['ani'] > warn_sim)\
                    & (Wndb['reference'] > Wndb['querry']) & (Wndb['alignment_coverage'] > warn_aln)]
-        for i,row in Wndb.iterrows():
-            c1 = Cdb['secondary_cluster'][Cdb['genome'] == row['reference']].tolist()[0]
-            c2 = Cdb['secondary_cluster'][Cdb['genome'] == row['querry']].tolist()[0]
+        for row in Wndb[['reference', 'querry', 'ani', 'alignment_coverage']]\
+                .itertuples(index=False):
+            c1 = genome2cluster[row.reference]
+            c2 = genome2cluster[row.querry]
 
             warning = "WINNER WARNING: Genomes {0} ({3}) and {1} ({4}) have a high ANIn score ({2:.2f}% ANI ".format(\
-                        row['reference'], row['querry'], row['ani']*100, c1, c2) + "; {0:.2f}% aligned)".format(row['alignment_coverage'])
+                        row.reference, row.querry, row.ani*100, c1, c2) + "; {0:.2f}% aligned)".format(row.alignment_coverage)
             warnings.append(warning)
 
     return warnings
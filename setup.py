@@ -25,4 +25,7 @@ setup(name='drep',
           'sklearn',
           'pytest'
       ],
+      extras_require={
+          'numba': ['numba']
+      },
       zip_safe=False)
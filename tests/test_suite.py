@@ -7,13 +7,17 @@
 ###############################################################################
 
 import glob
+import io
 import os
 import pytest
 import shutil
 import logging
 
+import numpy as np
 import pandas as pd
+import scipy.spatial.distance as ssd
 
+import drep.d_cluster as dClust
 from drep import argumentParser
 from drep.controller import Controller
 from drep.WorkDirectory import WorkDirectory
@@ -544,6 +548,17 @@ class UnitTests():
         run all tests
         '''
         self.test1()
+        self.run_cluster()
+
+    def run_cluster(self):
+        '''
+        run the tests of d_cluster
+        '''
+        self.test3()
+        self.test4()
+        self.test5()
+        self.test6()
+        self.test7()
 
     def test1(self):
         '''
@@ -570,6 +585,112 @@ class UnitTests():
         '''
         pass
 
+    def test3(self):
+        '''
+        test gen_condensed_dist against squareform of the pivot table
+        '''
+        names = ['c', 'a', 'd', 'b']
+        dists = {('a','b'):.1, ('a','c'):.2, ('a','d'):.3, ('b','c'):.4, \
+                ('b','d'):.5, ('c','d'):.6}
+        rows = []
+        for g1 in names:
+            for g2 in names:
+                d = 0 if g1 == g2 else dists[tuple(sorted([g1, g2]))]
+                rows.append([g1, g2, d])
+        db = pd.DataFrame(rows, columns=['genome1', 'genome2', 'dist'])
+
+        dist, cnames = dClust.gen_condensed_dist(db, 'genome1', 'genome2')
+        pdb = db.pivot(index='genome1', columns='genome2', values='dist')
+        assert cnames == list(pdb.columns)
+        assert np.allclose(dist, ssd.squareform(pdb.values))
+
+        # A missing pair is an error
+        db = db[~db['genome1'].isin(['a', 'b']) | ~db['genome2'].isin(['a', 'b'])]
+        with pytest.raises(AssertionError, match='1 of 6 pairwise comparisons'):
+            dClust.gen_condensed_dist(db, 'genome1', 'genome2')
+
+    def test4(self):
+        '''
+        test gen_avani_dist_db against averaging each pair by hand and pivoting
+        '''
+        names = ['b', 'c', 'a']
+        rows = []
+        for i, q in enumerate(names):
+            for j, r in enumerate(names):
+                ani = .999 if q == r else 0.9 + (0.01 * i) + (0.001 * j)
+                rows.append([q, r, ani])
+        db = pd.DataFrame(rows, columns=['querry', 'reference', 'ani'])
+
+        combo2value = {(q, r):a for q, r, a in rows}
+        db['dist'] = [0 if q == r else 1 - np.mean([combo2value[(q, r)], \
+                    combo2value[(r, q)]]) for q, r in zip(db['querry'], db['reference'])]
+        edb = db.pivot(index='reference', columns='querry', values='dist')
+
+        adb = dClust.gen_avani_dist_db(db)
+        assert list(adb.index) == list(edb.index)
+        assert list(adb.columns) == list(edb.columns)
+        assert np.allclose(adb.values, edb.values)
+
+    def test5(self):
+        '''
+        test add_symmetric_deltas
+        '''
+        rows = [('a', 'a', 100, 1), ('a', 'b', 80, 5), ('b', 'b', 90, 0)]
+        srows = dClust.add_symmetric_deltas(rows)
+
+        assert sorted(srows) == sorted(rows + [('b', 'a', 80, 5)])
+        assert len(srows) == 4
+
+    def test6(self):
+        '''
+        test that the byte-walking delta parser matches the line-by-line one
+        '''
+        deltas = glob.glob(os.path.join(load_solutions_wd(), 'data/ANIn_files/*.delta'))
+        assert len(deltas) > 0
+
+        for delta in deltas:
+            with open(delta, 'rb') as fh:
+                buf = np.frombuffer(fh.read(), dtype=np.uint8)
+            aln_length, sim_errors = dClust._parse_delta_buffer(buf)
+            assert (int(aln_length), int(sim_errors)) == \
+                    dClust._parse_delta_lines(delta), delta
+
+    def test7(self):
+        '''
+        test making Mdb from the lower triangle reported by mash triangle -E
+        '''
+        locations = ['/x/a.fa', '/x/b.fa', '/x/c.fa']
+        stream = io.StringIO("/x/b.fa\t/x/a.fa\t0.1\t1e-10\t50/1000\n" \
+                + "/x/c.fa\t/x/a.fa\t0.2\t1e-05\t20/1000\n" \
+                + "/x/c.fa\t/x/b.fa\t0.3\t0.001\t5/1000\n")
+        mdb = dClust.parse_mash_triangle(stream)
+        Mdb = dClust.gen_mdb_from_triangle(mdb, locations, 1000)
+
+        # Every ordered pair, including self-comparisons, is there once
+        assert len(Mdb) == 9
+        assert len(Mdb.groupby(['genome1', 'genome2'])) == 9
+
+        # Reverse comparisons mirror the reported ones
+        rows = {(g1, g2):(d, p, k) for g1, g2, d, p, k in zip(Mdb['genome1'], \
+                Mdb['genome2'], Mdb['dist'], Mdb['p'], Mdb['kmers'])}
+        for g1, g2, d, p, k in [('b.fa', 'a.fa', .1, 1e-10, '50/1000'), \
+                ('c.fa', 'a.fa', .2, 1e-05, '20/1000'), ('c.fa', 'b.fa', .3, .001, '5/1000')]:
+            for key in [(g1, g2), (g2, g1)]:
+                assert np.isclose(rows[key][0], d) and (rows[key][1] == p) \
+                        and (rows[key][2] == k), key
+
+        # Self-comparisons are made up
+        sdb = Mdb[Mdb['genome1'] == Mdb['genome2']]
+        assert sorted(sdb['genome1']) == ['a.fa', 'b.fa', 'c.fa']
+        assert (sdb['dist'] == 0).all() and (sdb['p'] == 0).all()
+        assert (sdb['kmers'] == '1000/1000').all()
+        assert np.allclose(Mdb['similarity'], 1 - Mdb['dist'])
+
+        # A single genome gives nothing for mash to report
+        mdb = dClust.parse_mash_triangle(io.StringIO(''))
+        Mdb = dClust.gen_mdb_from_triangle(mdb, locations[:1], 1000)
+        assert Mdb[['genome1', 'genome2']].values.tolist() == [['a.fa', 'a.fa']]
+
 def filter_test():
     ''' test the filter operation '''
     verifyFilter = VerifyFilter()
@@ -598,6 +719,10 @@ def unit_test():
     ''' run simple unit tests'''
     UnitTests().run()
 
+def cluster_unit_test():
+    ''' run simple unit tests of d_cluster'''
+    UnitTests().run_cluster()
+
 def taxonomy_test():
     '''
     Test taxonomy methods
@@ -626,6 +751,10 @@ def test_quick():
 def test_unit():
     unit_test()
 
+@pytest.mark.unit
+def test_unit_cluster():
+    cluster_unit_test()
+
 if __name__ == '__main__':
     #analyze_test()
     test_unit()